@@ -6,16 +6,18 @@ CAN device tester.
 """
 
 import argparse
+import functools
 import os.path
 import queue
 import socket
+import subprocess
 import sys
 import textwrap
 import threading
 import time
 import urllib.request
 import xml.etree.ElementTree as ET
-from subprocess import PIPE, Popen
+from concurrent.futures import ThreadPoolExecutor
 
 import can
 import serial
@@ -23,8 +25,16 @@ import serial.tools.list_ports
 
 import netifaces
 
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
 VSCAN_OK = b'\r'
 VSCAN_KO = b'\x07'
+CMD_TIMEOUT = 0.1
+# USB VID:PID pairs of the FT-X chip used by USB-CAN Plus
+USB_CAN_IDS = {(0x0403, 0x6015)}
 MCAST_GRP = '239.255.255.250'
 MCAST_PORT = 1900
 
@@ -123,40 +133,109 @@ class UsbCan(object):
     def __init__(self, port):
         self.port = port
         self.ser_port = None
+        self.messages = []
+
+    def log(self, msg):
+        """Collect a message for the device report."""
+        self.messages.append(f"{self.port}: {msg}")
+
+    def is_local(self):
+        """Check whether the port is a device and not a pySerial URL."""
+        return '://' not in self.port
 
     def close(self):
         """Close serial port."""
         self.ser_port.close()
 
-    def init_serial_port(self):
-        """Initialize serial port."""
+    def init_serial_port(self, probe_only=False):
+        """
+        Initialize serial port. In probe mode, hardware handshake is
+        disabled as only short ASCII commands will be exchanged.
+        """
         ret = True
+        handshake = not probe_only
+        # network round-trips of URL ports may exceed the short timeout
+        timeout = CMD_TIMEOUT if self.is_local() else 1
         try:
-            self.ser_port = serial.serial_for_url(self.port,
-                                                  baudrate=3000000,
-                                                  timeout=1,
-                                                  rtscts=True)
+            if sys.platform.startswith('linux') and self.is_local():
+                # lock the port, so that other instances can't open it
+                self.ser_port = serial.Serial(self.port,
+                                              baudrate=3000000,
+                                              timeout=timeout,
+                                              rtscts=handshake,
+                                              dsrdtr=False,
+                                              exclusive=True)
+            else:
+                self.ser_port = serial.serial_for_url(self.port,
+                                                      baudrate=3000000,
+                                                      timeout=timeout,
+                                                      rtscts=handshake,
+                                                      dsrdtr=False)
         except serial.serialutil.SerialException as err:
-            print(err)
+            self.log(err)
             ret = False
         except BrokenPipeError as err:
-            print(err)
+            self.log(err)
             ret = False
 
+        if ret and sys.platform.startswith('linux'):
+            self.set_low_latency()
+
         return ret
 
+    def set_low_latency(self):
+        """Lower FTDI latency timer to speed up command responses."""
+        if not self.is_local():
+            return
+
+        # FT-X chips wait up to 16ms before sending short packets
+        dev_name = os.path.basename(os.path.realpath(self.port))
+        try:
+            with open(f"/sys/bus/usb-serial/devices/{dev_name}/latency_timer",
+                      "w") as latency:
+                latency.write("1")
+        except FileNotFoundError:
+            # not a USB serial converter
+            return
+        except PermissionError:
+            # only root can write sysfs, but ASYNC_LOW_LATENCY below
+            # sets the same timer for normal users as well
+            pass
+        except OSError as err:
+            self.log(f"Failed to set latency timer: {err}")
+
+        try:
+            self.ser_port.set_low_latency_mode(True)
+        except (AttributeError, ValueError):
+            # driver doesn't support TIOCSSERIAL
+            pass
+
+    def read_response(self, size):
+        """Read a command response terminated by VSCAN_OK/VSCAN_KO."""
+        # wait for the first byte, then read what has already arrived
+        buf = bytearray(self.ser_port.read(1))
+        while (buf and len(buf) < size and
+               buf[-1:] != VSCAN_OK and buf[-1:] != VSCAN_KO):
+            chunk = self.ser_port.read(
+                min(max(self.ser_port.in_waiting, 1), size - len(buf)))
+            if not chunk:
+                break
+            buf += chunk
+
+        return bytes(buf)
+
     def close_can_channel(self):
         """Send 'C' to close the CAN channel."""
         try:
             self.ser_port.write("C\r".encode('ascii'))
         except serial.serialutil.SerialException as err:
-            print(err)
+            self.log(err)
             return False
 
         try:
-            buf = self.ser_port.read(1)
+            buf = self.read_response(1)
         except serial.serialutil.SerialException as err:
-            print(err)
+            self.log(err)
             return False
 
         if buf != VSCAN_KO and buf != VSCAN_OK:
@@ -165,12 +244,27 @@ class UsbCan(object):
         return True
 
     def lsof(self):
-        """Check if a port is already open."""
-        proc = Popen(["lsof"], stdout=PIPE, stderr=PIPE)
-        output = proc.communicate()[0]
-        for line in output.decode('ascii').split('\n'):
-            if line.find(self.port) != -1:
-                print(f"{self.port} is already open:\n{line}")
+        """Find a process that holds the port open."""
+        port_path = os.path.realpath(self.port)
+        for proc in os.scandir('/proc'):
+            if not proc.name.isdigit():
+                continue
+            try:
+                fds = list(os.scandir(f"{proc.path}/fd"))
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    if os.readlink(fd.path) != port_path:
+                        continue
+                    with open(f"{proc.path}/comm", "r") as comm:
+                        name = comm.read().strip()
+                except OSError:
+                    continue
+                return (f"{self.port} is already open:\n"
+                        f"{name} (PID: {proc.name}, FD: {fd.name})")
+
+        return None
 
     def get_serial_number(self):
         """Send 'N' to get the serial number."""
@@ -178,19 +272,19 @@ class UsbCan(object):
         try:
             self.ser_port.write("N\r".encode('ascii'))
         except serial.serialutil.SerialException as err:
-            print(err)
+            self.log(err)
             return ser_num
 
-        buf = self.ser_port.read(12)
-        if buf[0] != 78:
-            print(f"Wrong first character: {buf[0]}")
+        buf = self.read_response(12)
+        if not buf.startswith(b'N'):
+            self.log(f"Wrong first character: {buf[:1]}")
             return ser_num
 
-        if buf[len(buf) - 1] != 13:
-            print(f"Wrong last character: {buf[len(buf) - 1]}")
+        if not buf.endswith(VSCAN_OK):
+            self.log(f"Wrong last character: {buf[-1:]}")
             return ser_num
 
-        return buf[1:len(buf) - 2]
+        return buf[1:-2]
 
     def get_version_info(self):
         """Send 'V' to get the firmware version."""
@@ -198,49 +292,152 @@ class UsbCan(object):
         try:
             self.ser_port.write("V\r".encode('ascii'))
         except serial.serialutil.SerialException as err:
-            print(err)
+            self.log(err)
             return ver
 
-        buf = self.ser_port.read(6)
-        if buf[0] != 86:
-            print(f"Wrong first character: {buf[0]}")
+        buf = self.read_response(6)
+        if not buf.startswith(b'V'):
+            self.log(f"Wrong first character: {buf[:1]}")
             return ver
 
-        if buf[len(buf) - 1] != 13:
-            print(f"Wrong last character: {buf[len(buf) - 1]}")
+        if not buf.endswith(VSCAN_OK):
+            self.log(f"Wrong last character: {buf[-1:]}")
             return ver
 
-        return buf[1:len(buf) - 1]
+        return buf[1:-1]
 
 
 def find_all_usb_can_devices():
-    """Find all serial ports with FT-X chip."""
-    port_list = []
-    ports = serial.tools.list_ports.grep("0403:6015")
-    for item in ports:
-        port_list.append(item.device)
+    """Find all serial ports with FT-X chip and their descriptions."""
+    if pyudev and sys.platform.startswith('linux'):
+        try:
+            ports = find_udev_usb_can_devices()
+        except (ImportError, OSError):
+            # libudev is missing or not usable
+            ports = None
+        # an empty result can also mean there is no udev database
+        if ports:
+            return ports
+
+    return {item.device: item.description
+            for item in serial.tools.list_ports.comports()
+            if (item.vid, item.pid) in USB_CAN_IDS}
+
+
+def find_udev_usb_can_devices():
+    """Find all tty devices with FT-X chip using udev database."""
+    ports = []
+    context = pyudev.Context()
+    # udev ORs property matches, so only the vendor is filtered here
+    for vid in {vid for vid, _ in USB_CAN_IDS}:
+        for dev in context.list_devices(subsystem='tty',
+                                        ID_VENDOR_ID=f"{vid:04x}"):
+            pid = dev.properties.get('ID_MODEL_ID')
+            if pid and (vid, int(pid, 16)) in USB_CAN_IDS:
+                # udev replaces spaces in the product name with underscores
+                model = dev.properties.get('ID_MODEL', '')
+                ports.append((dev.device_node, model.replace('_', ' ')))
+
+    return dict(sorted(ports))
+
+
+def find_port(port, ports):
+    """Find serial port in the list."""
+    description = ports.get(port)
+    if description is not None:
+        print(f"Serial port found: {port} - {description}")
+        if description.find('USB-CAN Plus') != -1:
+            print("This device has a correct description")
+        else:
+            print(f"Device description is wrong: {description}")
 
-    return port_list
 
+def probe_device(port):
+    """Query a device and return its report lines and status."""
+    usbcan = UsbCan(port)
+    info = query_device(usbcan)
+    if info:
+        usbcan.messages.append("Found VSCAN device with the following info:")
+        usbcan.messages.append(f"{port} -> {info}")
+        return usbcan.messages, True
 
-def find_port(port):
-    """Find serial port in the list."""
-    ports = serial.tools.list_ports.grep(port)
-    for item in ports:
-        if item.device == port:
-            print(f"Serial port found: {item}")
-            if item.description.find('USB-CAN Plus') != -1:
-                print("This device has a correct description")
-            else:
-                print(f"Device description is wrong: {item.description}")
+    if sys.platform.startswith('linux'):
+        holder = usbcan.lsof()
+        if holder:
+            usbcan.messages.append(holder)
+
+    return usbcan.messages, False
+
+
+def query_device(usbcan):
+    """Send the ASCII commands and return the device info."""
+    if not usbcan.init_serial_port(probe_only=True):
+        usbcan.log("Failed to open serial port")
+        return None
+
+    try:
+        if not usbcan.close_can_channel():
+            usbcan.log("Failed to close the CAN channel")
+            usbcan.messages.append("The port could be opened but this "
+                                   "device doesn't respond to the ASCII "
+                                   "commands")
+            return None
+
+        ser_num = usbcan.get_serial_number()
+        if not ser_num:
+            usbcan.log("Failed to get the serial number")
+            return None
+
+        ver = usbcan.get_version_info()
+        if not ver:
+            usbcan.log("Failed to get the firmware version")
+            return None
+    except serial.serialutil.SerialException as err:
+        usbcan.log(err)
+        return None
+    finally:
+        usbcan.close()
+
+    # version is four hex digits: HW major/minor, FW major/minor
+    # int() alone would also accept signs, underscores and whitespace
+    if (len(ver) != 4 or
+            not all(c in b'0123456789abcdefABCDEF' for c in ver)):
+        usbcan.log(f"Malformed version response: {ver}")
+        return None
+
+    try:
+        ser_num = ser_num.decode('ascii')
+        ver_num = int(ver, 16)
+    except (UnicodeDecodeError, ValueError):
+        usbcan.log(f"Malformed response: SN {ser_num}, version {ver}")
+        return None
+
+    hw_major = (ver_num >> 12) & 0xF
+    hw_minor = (ver_num >> 8) & 0xF
+    ver_major = (ver_num >> 4) & 0xF
+    ver_minor = ver_num & 0xF
+    return (f"(SN: {ser_num}, "
+            f"FW: {ver_major}:{ver_minor}, "
+            f"HW: {hw_major}:{hw_minor})")
 
 
+@functools.lru_cache(maxsize=None)
 def check_lsmod(driver):
-    """Invoke lsmod and check for ftdi_sio driver."""
-    proc = Popen(["lsmod"], stdout=PIPE, stderr=PIPE)
-    output = proc.communicate()[0]
-    for line in output.decode('ascii').split('\n'):
-        if driver in line:
+    """Check /proc/modules or lsmod output for a loaded driver."""
+    try:
+        with open("/proc/modules", "rb") as mods:
+            lines = mods.read().splitlines()
+    except OSError:
+        try:
+            lines = subprocess.run(["lsmod"],
+                                   capture_output=True,
+                                   check=False).stdout.splitlines()
+        except OSError:
+            return False
+
+    drv_name = driver.encode('ascii')
+    for line in lines:
+        if line.split(b' ', 1)[0] == drv_name:
             return True
 
     return False
@@ -257,6 +454,13 @@ def find_file(path, drv_file_name):
 
 def find_driver(kernel_ver, drv_name):
     """Check whether slcan is available on the system."""
+    # return a copy, so that callers can't modify the cached result
+    return dict(_find_driver(kernel_ver, drv_name))
+
+
+@functools.lru_cache(maxsize=None)
+def _find_driver(kernel_ver, drv_name):
+    """Look up driver state in /proc and /lib/modules."""
     drv_info = {'loaded': False, 'state': 'na'}
 
     if check_lsmod(drv_name):
@@ -280,6 +484,12 @@ def find_driver(kernel_ver, drv_name):
     return drv_info
 
 
+@functools.lru_cache(maxsize=None)
+def _kernel_release():
+    """Get kernel version."""
+    return os.uname().release
+
+
 def fix_port_type(port):
     """
     If a port is an IP address with a port number,
@@ -338,10 +548,7 @@ def show_driver_info(drv_name, drv_info):
 
 def get_system_info():
     """Get system information."""
-    # get kernel version
-    proc = Popen(["uname", "-r"], stdout=PIPE, stderr=PIPE)
-    output = proc.communicate()[0]
-    kernel_ver = output.decode('ascii').split('\n')[0]
+    kernel_ver = _kernel_release()
 
     print(f"Kernel: {kernel_ver}")
 
@@ -367,7 +574,7 @@ def receive_can_frames(port, bitrate):
 
     while True:
         msg = bus.recv()
-        data = "".join("{:02X} ".format(byte) for byte in msg.data)
+        data = msg.data.hex(' ').upper()
         print("{:X} [{}] {}".format(msg.arbitration_id,
                                     msg.dlc,
                                     data))
@@ -459,16 +666,6 @@ def main():
             get_system_info()
             sys.exit(0)
 
-    port_list = []
-    if args.port == 'all':
-        port_list = find_all_usb_can_devices()
-        if not port_list:
-            print("No USB-CAN devices found")
-            if sys.platform.startswith('linux'):
-                get_system_info()
-    else:
-        port_list.append(fix_port_type(args.port))
-
     if args.rx:
         if args.port == 'all':
             print("Please specify a port")
@@ -484,42 +681,40 @@ def main():
             send_can_frames(fix_port_type(args.port), args.bitrate, args.tx)
             sys.exit(0)
 
-    for item in port_list:
-        usbcan = UsbCan(item)
-        if sys.platform.startswith('linux'):
-            find_port(usbcan.port)
-            usbcan.lsof()
-
-        if not usbcan.init_serial_port():
-            print("Failed to open serial port")
-            sys.exit(1)
-
-        if not usbcan.close_can_channel():
-            print("Failed to close the CAN channel")
-            print("The port could be opened but this "
-                  "device doesn't respond to the ASCII commands")
-            sys.exit(1)
+    # enumerate serial ports only once and only if needed
+    ports = {}
+    port_list = []
+    if args.port == 'all':
+        ports = find_all_usb_can_devices()
+        port_list = list(ports)
+        if not port_list:
+            print("No USB-CAN devices found")
+            if sys.platform.startswith('linux'):
+                get_system_info()
+    else:
+        port = fix_port_type(args.port)
+        port_list.append(port)
+        if sys.platform.startswith('linux') and '://' not in port:
+            ports = {item.device: item.description
+                     for item in serial.tools.list_ports.comports()}
 
-        ser_num = usbcan.get_serial_number()
-        if not ser_num:
-            print("Failed to get the serial number")
-            sys.exit(1)
+    if sys.platform.startswith('linux'):
+        for item in port_list:
+            find_port(item, ports)
 
-        ver = usbcan.get_version_info()
-        if not ver:
-            print("Failed to get the firmware version")
-            sys.exit(1)
+    if not port_list:
+        return
 
-        ver_major = int(ver[2:3], 16)
-        ver_minor = int(ver[3:], 16)
-        hw_major = int(ver[:1], 16)
-        hw_minor = int(ver[1:2], 16)
-        print(f"Found VSCAN device with the following info:")
-        print(f"{usbcan.port} -> (SN: {ser_num.decode('ascii')}, "
-              f"FW: {ver_major}:{ver_minor}, "
-              f"HW: {hw_major}:{hw_minor})")
+    # each device is probed independently, so do it in parallel
+    failed = False
+    with ThreadPoolExecutor(max_workers=min(8, len(port_list))) as executor:
+        for report, ok in executor.map(probe_device, port_list):
+            print("\n".join(report))
+            if not ok:
+                failed = True
 
-        usbcan.close()
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
 """
@@ -11,6 +11,8 @@ import can
 import serial
 
 CAN_DEV = '/dev/ttyUSB0@3000000'
+# maximum number of frames written at once
+MAX_BATCH = 256
 
 
 def main():
@@ -24,14 +26,30 @@ def main():
         print(err)
         sys.exit(1)
 
-    while True:
-        msg = bus.recv()
-        data = "".join("{:02X} ".format(byte) for byte in msg.data)
-        print("{:X} [{}] {}".format(msg.arbitration_id,
-                                    msg.dlc,
-                                    data))
+    out = sys.stdout.buffer
 
-    bus.shutdown()
+    try:
+        while True:
+            msg = bus.recv()
+            if msg is None:
+                continue
+
+            # drain pending frames and write them at once
+            lines = []
+            while msg is not None:
+                data = msg.data.hex(' ').upper()
+                lines.append("{:X} [{}] {}\n".format(msg.arbitration_id,
+                                                     msg.dlc,
+                                                     data))
+                if len(lines) == MAX_BATCH:
+                    break
+                msg = bus.recv(timeout=0)
+            out.write("".join(lines).encode('ascii'))
+            out.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bus.shutdown()
 
 
 if __name__ == '__main__':